@@ -6,6 +6,30 @@ import pandas as pd
 from utils.borrower import get_borrower_to_last_lender
 
 
+def get_city_lender_to_loan_amount_bins(
+    df: pd.DataFrame, bin_edges: List[int], bin_labels: List[str]
+) -> pd.DataFrame:
+    """
+    Same as get_lender_to_loan_amount_bins, but counts loans per city as well,
+    so that all cities can be binned with a single pd.cut and groupby.
+    Returns a DataFrame with columns: city, lender, loan_amount_bin, num_loans.
+    """
+    # Group by the bin Series directly rather than adding a column, so the
+    # (possibly large) input DataFrame doesn't have to be copied
+    loan_amount_bin: pd.Series = pd.cut(
+        df["loanAmount"], bins=bin_edges, labels=bin_labels, right=False
+    ).rename("loan_amount_bin")
+    # Group by city, lender and bin, count number of loans
+    grouped = (
+        df.groupby(["city", "lenderName", loan_amount_bin], observed=True)
+        .size()
+        .reset_index()
+    )
+    grouped = grouped.rename(columns={0: "num_loans", "lenderName": "lender"})
+
+    return grouped
+
+
 def get_fromto_lenders_w_borrower(
     prepped_data: List[Dict],
 ) -> List[Tuple[str, str, str]]:
@@ -1,5 +1,5 @@
 import math
-from typing import Dict, List, Tuple
+from typing import Dict, List
 
 import pandas as pd
 import streamlit as st
@@ -8,11 +8,10 @@ from constants.dataset import LOCATION
 from pipelines.prepare_loan_data import prep_data
 from utils.gui import show_default_footer, show_st_h1, show_st_h2, show_st_info
 from utils.io import load_json
-from utils.lender import get_lender_to_loan_amount_bins
+from utils.lender import get_city_lender_to_loan_amount_bins
 from utils.market_share_stacked_bar import (
     BIN_EDGE_TO_LABEL,
     LABEL_SEPARATOR,
-    get_edge_range,
     show_lender_market_share_stacked_bar,
 )
 
@@ -21,11 +20,33 @@ BIN_NUM_LOANS_MIN_THREASHOLD = 10
 HIGH_HHI_SEGMENT = "Top 10 Segments by Market Concentration"
 LOW_HHI_SEGMENT = "Top 10 Most Fragmented Market Segments"
 ALL_SEGMENT = "All Market Segments"
+# Ensure bin edges and bin labels are in ascending order for pd.cut
+SORTED_BIN_EDGES: List[int] = sorted(BIN_EDGE_TO_LABEL.keys())
+BIN_EDGES: List[int] = [0] + SORTED_BIN_EDGES
+BIN_LABELS: List[str] = [BIN_EDGE_TO_LABEL[edge] for edge in SORTED_BIN_EDGES]
+
+
+@st.cache_data(show_spinner=False)
+def _load_df(prepped_data_file_path: str) -> pd.DataFrame:
+    prepped_data: List[Dict] = load_json(prepped_data_file_path)
+    # Only keep the columns this page uses, so the cached DataFrame and every
+    # filter and groupby over it don't carry the rest of the prepped data
+    df = pd.DataFrame(prepped_data, columns=["city", "lenderName", "loanAmount"])
+    # float32 holds whole-dollar loan amounts exactly (up to 2**24) and halves
+    # the memory the binning has to read
+    df["loanAmount"] = pd.to_numeric(
+        df["loanAmount"], errors="coerce", downcast="float"
+    )
+    # City is repeated across many loans, so a categorical makes the city
+    # membership filters and groupbys work on integer codes instead of strings
+    df["city"] = df["city"].astype("category")
+
+    return df
 
 
 def _get_above_threshold_df(df: pd.DataFrame) -> pd.DataFrame:
     # Group by city and count the number of loans in each city
-    city_loan_counts = df.groupby("city").size()
+    city_loan_counts = df.groupby("city", sort=False, observed=True).size()
     city_loan_counts.name = "loan_count"
     city_loan_counts = city_loan_counts.reset_index()
 
@@ -38,137 +59,133 @@ def _get_above_threshold_df(df: pd.DataFrame) -> pd.DataFrame:
     ]
 
     print(f"Disregard cities with loan counts < {CITY_NUM_LOANS_MIN_THREASHOLD}")
-    for _, row in below_threshold.iterrows():
-        print(f"{row['city']}: {row['loan_count']}")
+    if not below_threshold.empty:
+        print(below_threshold.to_string(index=False))
 
     return above_or_equal_threshold
 
 
 def _get_selected_score_records(
-    score_records: List[Dict], selected_min_num_loans: int, market_category: str
-) -> List[Dict]:
-    filtered_records = [
-        record
-        for record in score_records
-        if record["bin_num_loans"] >= selected_min_num_loans
-    ]
-
+    score_records: pd.DataFrame, selected_min_num_loans: int, market_category: str
+) -> pd.DataFrame:
+    # Every branch returns a frame with a fresh 0..N index, since the row labels
+    # of the cached score_records are shown in the chart data table
+    is_selected: pd.Series = score_records["bin_num_loans"] >= selected_min_num_loans
+
+    # For the top 10 categories, rank only the filtered hhi column and take the
+    # rows of the top 10, rather than first copying every selected row
     if market_category == HIGH_HHI_SEGMENT:
-        # Sort by highest HHI (most monopolized) and take top 10
-        sorted_records = sorted(filtered_records, key=lambda x: x["hhi"], reverse=True)
-        return sorted_records[:10]
+        # Take the top 10 by highest HHI (most monopolized)
+        top_index: pd.Index = score_records["hhi"][is_selected].nlargest(10).index
+        return score_records.loc[top_index].reset_index(drop=True)
     elif market_category == LOW_HHI_SEGMENT:
-        # Sort by lowest HHI (most diverse) and take top 10
-        sorted_records = sorted(filtered_records, key=lambda x: x["hhi"])
-        return sorted_records[:10]
+        # Take the top 10 by lowest HHI (most diverse)
+        top_index: pd.Index = score_records["hhi"][is_selected].nsmallest(10).index
+        return score_records.loc[top_index].reset_index(drop=True)
     else:
-        order_map = {
-            "$5M - $10M": 1,
-            "$2.5M - $5M": 2,
-            "$1M - $2.5M": 3,
-            "$500K - $1M": 4,
-            "$250K - $500K": 5,
-            "$100K - $250K": 6,
-            "$50K - $100K": 7,
-            "$0 - $50K": 8,
-        }
-        sorted_records = sorted(
-            filtered_records, key=lambda x: order_map.get(x["loan_amount_bin"], 999)
+        # loan_amount_bin is an ordered categorical in ascending BIN_LABELS order,
+        # so sorting descending orders segments from the largest loan amounts down
+        sorted_records = (
+            score_records[is_selected]
+            .sort_values("loan_amount_bin", ascending=False, kind="stable")
+            .reset_index(drop=True)
         )
         return sorted_records
 
 
-def _get_score_records(
-    df: pd.DataFrame, above_threshold_cities: List[str]
-) -> List[Dict]:
-    # For each city in above_or_equal_threshold, create a new DataFrame with rows from df that match the city
-    city_to_df: Dict[str, pd.DataFrame] = {}
-    for city, city_df in df[df["city"].isin(above_threshold_cities)].groupby("city"):
-        city_to_df[str(city)] = city_df.copy()
-
-    # Ensure bin_edges and bin_labels are in ascending order for pd.cut
-    bin_edges: List[int] = [0] + sorted(BIN_EDGE_TO_LABEL.keys())
-    bin_labels: List[str] = [
-        BIN_EDGE_TO_LABEL[edge] for edge in sorted(BIN_EDGE_TO_LABEL.keys())
-    ]
-
-    # for each city:
-    score_records: List[Dict] = []
-    for city, city_df in city_to_df.items():
-        lender_to_loan_amount_bins: pd.DataFrame = get_lender_to_loan_amount_bins(
-            city_df, bin_edges, bin_labels
-        )
-        # Add a column 'bin_num_loans' that sums num_loans for each loan_amount_bin
-        bin_num_loans = lender_to_loan_amount_bins.groupby(
-            "loan_amount_bin", observed=True
-        )["num_loans"].transform("sum")
-        lender_to_loan_amount_bins["bin_num_loans"] = bin_num_loans
-
-        lender_to_loan_amount_bins["lender_num_loans_pct"] = (
-            lender_to_loan_amount_bins["num_loans"]
-            / lender_to_loan_amount_bins["bin_num_loans"]
-            * 100
-        )
+@st.cache_data(show_spinner=False)
+def _get_score_records(prepped_data_file_path: str) -> pd.DataFrame:
+    """
+    Returns a DataFrame with one row per market segment and the following columns:
+    - city: categorical ("DOVER")
+    - loan_amount_bin: categorical ("$100K - $250K")
+    - bin_num_loans: int (22)
+    - bin_num_loans_pct_std_dev: float (2.67)
+    - hhi: float (702.48)
+
+    Cached on the prepped data file path so that reruns triggered by widget
+    interactions skip the per-city HHI computation.
+    """
+    df: pd.DataFrame = _load_df(prepped_data_file_path)
+    above_threshold_df: pd.DataFrame = _get_above_threshold_df(df)
+    above_threshold_cities: pd.Index = pd.Index(above_threshold_df["city"])
 
-        lender_to_loan_amount_bins = lender_to_loan_amount_bins[
-            lender_to_loan_amount_bins["bin_num_loans"] >= BIN_NUM_LOANS_MIN_THREASHOLD
-        ]
+    # Bin the loans of all cities in one pass instead of once per city
+    lender_to_loan_amount_bins: pd.DataFrame = get_city_lender_to_loan_amount_bins(
+        df[df["city"].isin(above_threshold_cities)], BIN_EDGES, BIN_LABELS
+    )
+    lender_to_loan_amount_bins["num_loans"] = lender_to_loan_amount_bins[
+        "num_loans"
+    ].astype("int32")
+    bin_keys: List[str] = ["city", "loan_amount_bin"]
+
+    # Add a column 'bin_num_loans' that sums num_loans for each city and loan_amount_bin
+    lender_to_loan_amount_bins["bin_num_loans"] = lender_to_loan_amount_bins.groupby(
+        bin_keys, observed=True
+    )["num_loans"].transform("sum")
+
+    lender_to_loan_amount_bins["lender_num_loans_pct"] = (
+        lender_to_loan_amount_bins["num_loans"]
+        / lender_to_loan_amount_bins["bin_num_loans"]
+        * 100
+    )
 
-        # Calculate the standard deviation of lender_num_loans_pct for each loan_amount_bin
-        bin_num_loans_pct_std_dev = lender_to_loan_amount_bins.groupby(
-            "loan_amount_bin", observed=True
-        )["lender_num_loans_pct"].transform("std")
-        lender_to_loan_amount_bins["bin_num_loans_pct_std_dev"] = (
-            bin_num_loans_pct_std_dev
-        )
+    # Calculate bin_num_loans, the standard deviation of lender_num_loans_pct and
+    # the Herfindahl-Hirschman Index (HHI) for each city and loan_amount_bin in one pass
+    lender_to_loan_amount_bins["lender_num_loans_pct_sq"] = (
+        lender_to_loan_amount_bins["lender_num_loans_pct"] ** 2
+    )
+    bin_stats: pd.DataFrame = lender_to_loan_amount_bins.groupby(
+        bin_keys, observed=True
+    ).agg(
+        bin_num_loans=("num_loans", "sum"),
+        bin_num_loans_pct_std_dev=("lender_num_loans_pct", "std"),
+        hhi=("lender_num_loans_pct_sq", "sum"),
+    )
+    bin_stats["bin_num_loans"] = bin_stats["bin_num_loans"].astype("int32")
+    bin_stats = bin_stats[bin_stats["bin_num_loans"] >= BIN_NUM_LOANS_MIN_THREASHOLD]
 
-        # Calculate the Herfindahl-Hirschman Index (HHI) for each loan_amount_bin
-        hhi_by_bin = lender_to_loan_amount_bins.groupby(
-            "loan_amount_bin", observed=True
-        )["lender_num_loans_pct"].apply(lambda x: (x**2).sum())
-
-        # For each unique loan_amount_bin, add a row with city, loan_amount_bin, and bin_num_loans_pct_std_dev
-        for bin_value, group in lender_to_loan_amount_bins.groupby(
-            "loan_amount_bin", observed=True
-        ):
-            if group.empty:
-                continue
-            std_dev = group["bin_num_loans_pct_std_dev"].iloc[0]
-            bin_num_loans = group["bin_num_loans"].iloc[0]
-            hhi = hhi_by_bin[bin_value]  # Get the HHI specific to this bin
-            score_records.append(
-                {
-                    "city": city,
-                    "loan_amount_bin": bin_value,
-                    "bin_num_loans": bin_num_loans,
-                    "bin_num_loans_pct_std_dev": std_dev,
-                    "hhi": hhi,
-                }
-            )
+    score_records: pd.DataFrame = bin_stats.reset_index()
 
     return score_records
 
 
-def _get_stacked_bar_data(df: pd.DataFrame, score_records: List[Dict]) -> pd.DataFrame:
+def _get_stacked_bar_data(
+    df: pd.DataFrame, score_records: pd.DataFrame
+) -> pd.DataFrame:
     """
     Returns a DataFrame with the following columns:
     - lender: str ("KIAVI FUNDING INC)
-    - loan_amount_bin: str ("DOVER  |  $100K - $250K")
+    - loan_amount_bin: ordered categorical of str ("DOVER  |  $100K - $250K"),
+      with categories in the order of score_records
     - num_loans: int (10)
     """
-    amount_bin_level_dfs: List[pd.DataFrame] = []
-    for record in score_records:
-        city: str = record["city"]
-        loan_amount_bin: str = record["loan_amount_bin"]
-        city_level_df: pd.DataFrame = df[df["city"] == city]
-        joined_bin_label = f"{city}{LABEL_SEPARATOR}{loan_amount_bin}"
-        bin_edges: Tuple[int, int] = get_edge_range(loan_amount_bin)
-        bin_level_df: pd.DataFrame = get_lender_to_loan_amount_bins(
-            city_level_df, list(bin_edges), [joined_bin_label]
-        )
-        amount_bin_level_dfs.append(bin_level_df)
-
-    chart_df: pd.DataFrame = pd.concat(amount_bin_level_dfs, ignore_index=True)
+    # Bin the loans of the selected cities once, then keep only the selected
+    # (city, loan_amount_bin) segments, in the order of score_records. This
+    # produces chart_df from a single groupby and merge; avoid going back to
+    # building one small DataFrame per segment and pd.concat-ing them.
+    segment_keys: List[str] = ["city", "loan_amount_bin"]
+    selected_segments: pd.DataFrame = score_records[segment_keys].astype(str)
+    lender_to_loan_amount_bins: pd.DataFrame = get_city_lender_to_loan_amount_bins(
+        df[df["city"].isin(selected_segments["city"])], BIN_EDGES, BIN_LABELS
+    )
+    lender_to_loan_amount_bins["loan_amount_bin"] = lender_to_loan_amount_bins[
+        "loan_amount_bin"
+    ].astype(str)
+    chart_df: pd.DataFrame = selected_segments.merge(
+        lender_to_loan_amount_bins, on=segment_keys, how="inner"
+    )
+    joined_bin_labels: pd.Series = (
+        selected_segments["city"]
+        + LABEL_SEPARATOR
+        + selected_segments["loan_amount_bin"]
+    )
+    chart_df["loan_amount_bin"] = pd.Categorical(
+        chart_df["city"] + LABEL_SEPARATOR + chart_df["loan_amount_bin"],
+        categories=joined_bin_labels,
+        ordered=True,
+    )
+    chart_df = chart_df[["lender", "loan_amount_bin", "num_loans"]]
 
     return chart_df
 
@@ -199,10 +216,9 @@ def _show_introduction() -> None:
     )
 
 
-def _show_df(selected_score_records: List[Dict]) -> None:
+def _show_df(selected_score_records: pd.DataFrame) -> None:
     columns_to_keep = ["city", "loan_amount_bin", "bin_num_loans", "hhi"]
-    df = pd.DataFrame(selected_score_records)
-    df = df[columns_to_keep]
+    df = selected_score_records[columns_to_keep]
 
     st.dataframe(
         df,
@@ -216,18 +232,13 @@ def _show_df(selected_score_records: List[Dict]) -> None:
     )
 
 
-def _show_metrics_selected_data(selected_score_records: List[Dict]) -> None:
-    # Find max and min HHI values efficiently
-    max_hhi_value = max(record["hhi"] for record in selected_score_records)
-    min_hhi_value = min(record["hhi"] for record in selected_score_records)
-
-    # Find the corresponding records
-    max_hhi_record = next(
-        record for record in selected_score_records if record["hhi"] == max_hhi_value
-    )
-    min_hhi_record = next(
-        record for record in selected_score_records if record["hhi"] == min_hhi_value
-    )
+def _show_metrics_selected_data(selected_score_records: pd.DataFrame) -> None:
+    # Find the records with the max and min HHI values
+    hhi_values: pd.Series = selected_score_records["hhi"]
+    max_hhi_record: pd.Series = selected_score_records.loc[hhi_values.idxmax()]
+    min_hhi_record: pd.Series = selected_score_records.loc[hhi_values.idxmin()]
+    max_hhi_value = max_hhi_record["hhi"]
+    min_hhi_value = min_hhi_record["hhi"]
 
     max_hhi_label = f"  {max_hhi_record['city']}{LABEL_SEPARATOR}{max_hhi_record['loan_amount_bin']}"
     min_hhi_label = f"  {min_hhi_record['city']}{LABEL_SEPARATOR}{min_hhi_record['loan_amount_bin']}"
@@ -247,8 +258,8 @@ def _show_metrics_selected_data(selected_score_records: List[Dict]) -> None:
     )
 
 
-def _show_slider(score_records: List[Dict]) -> int:
-    max_bin_num_loans: int = max(record["bin_num_loans"] for record in score_records)
+def _show_slider(score_records: pd.DataFrame) -> int:
+    max_bin_num_loans: int = int(score_records["bin_num_loans"].max())
     max_value: int = math.ceil(max_bin_num_loans / 10) * 10
     min_value: int = BIN_NUM_LOANS_MIN_THREASHOLD
     default_value: int = min_value
@@ -273,7 +284,7 @@ def _show_slider(score_records: List[Dict]) -> int:
 
 
 def _show_stacked_bar(chart_df: pd.DataFrame) -> None:
-    sorted_bin_labels: List[str] = list(chart_df["loan_amount_bin"].unique())
+    sorted_bin_labels: List[str] = list(chart_df["loan_amount_bin"].cat.categories)
     height = max(70 * len(sorted_bin_labels), 160)
     y_title = None
     y_label_limit = 300
@@ -288,17 +299,12 @@ def render_page():
     show_st_h2(f"Market Concentration - {LOCATION}", w_divider=True)
 
     prepped_data_file_path: str = prep_data()
-    prepped_data: List[Dict] = load_json(prepped_data_file_path)
 
     st.write("")
     _show_introduction()
 
-    df = pd.DataFrame(prepped_data)
-    df["loanAmount"] = pd.to_numeric(df["loanAmount"], errors="coerce")
-
-    above_threshold_df: pd.DataFrame = _get_above_threshold_df(df)
-    above_threshold_cities: List[str] = list(above_threshold_df["city"])
-    score_records: List[Dict] = _get_score_records(df, above_threshold_cities)
+    df: pd.DataFrame = _load_df(prepped_data_file_path)
+    score_records: pd.DataFrame = _get_score_records(prepped_data_file_path)
 
     st.write("")
     selected_hhi_category: str = st.radio(
@@ -307,10 +313,10 @@ def render_page():
     )
     selected_min_num_loans: int = _show_slider(score_records)
 
-    selected_score_records: List[Dict] = _get_selected_score_records(
+    selected_score_records: pd.DataFrame = _get_selected_score_records(
         score_records, selected_min_num_loans, selected_hhi_category
     )
-    if not selected_score_records:
+    if selected_score_records.empty:
         show_st_info("no_data_selected")
         show_default_footer()
         return